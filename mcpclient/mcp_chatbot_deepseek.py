@@ -4,29 +4,108 @@ from contextlib import AsyncExitStack
 
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
+import logging
 import os
 import sys
-import requests
-from openai import OpenAI
+import threading
+import time
+import fastjsonschema
+import httpx
 from dotenv import load_dotenv
-import json
+import orjson
 
 
 #load env from .env file
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Resolved once at import instead of per-instantiation / per-connect
+_MODEL = os.getenv("MODEL")
+_DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+
+# O(1) dispatch from server-script extension to interpreter
+_EXT_TO_CMD = {".py": "python", ".js": "node"}
+
+# Batch streamed tokens on ~50ms boundaries before writing to the terminal
+# so a fast stream doesn't turn into one syscall per token.
+_STREAM_FLUSH_INTERVAL = 0.05
+
+# Unix socket used by --daemon mode; a later plain invocation becomes a
+# thin client of the warm daemon instead of paying cold-start again
+_DAEMON_SOCKET = os.getenv("MCP_DAEMON_SOCKET", "/tmp/mcp-chatbot.sock")
+
+# Max queries processed concurrently when several are already queued
+# on stdin (piped/scripted input); interactive use still sees one at a time.
+_MAX_QUERY_BATCH = int(os.getenv("MAX_QUERY_BATCH", "4"))
+
+# Character budget for the message history; past it, stale tool results
+# are elided so long tool chains stop re-sending O(N^2) bytes per turn.
+_MAX_HISTORY_CHARS = int(os.getenv("MAX_HISTORY_CHARS", "32000"))
+_ELIDED_KEEP = 200  # chars kept at each end of an elided tool result
+
+
+def _tool_text(result) -> str:
+    """Extract the textual payload from a CallToolResult.
+
+    str(result) reprs the whole object — base64 blobs, metadata and all —
+    inflating the prompt tokens of every later turn. Pull out the text
+    parts and fall back to JSON for structured content.
+    """
+    parts = []
+    for item in result.content:
+        text = getattr(item, "text", None)
+        parts.append(text if text is not None else orjson.dumps(item.model_dump()).decode())
+    return "\n".join(parts)
+
+
+def _trim_history(messages):
+    """Elide old tool results in place once the history exceeds the budget.
+
+    The system prompt, user query and the most recent turns stay intact;
+    tool payloads older than the last two turns are cut down to their
+    first/last _ELIDED_KEEP chars.
+    """
+    total = sum(len(m.get("content") or "") for m in messages)
+    if total <= _MAX_HISTORY_CHARS:
+        return
+    for message in messages[:-4]:
+        content = message.get("content") or ""
+        if message.get("role") == "tool" and len(content) > 2 * _ELIDED_KEEP:
+            message["content"] = (
+                content[:_ELIDED_KEEP]
+                + f"\n...[{len(content) - 2 * _ELIDED_KEEP} chars elided]...\n"
+                + content[-_ELIDED_KEEP:]
+            )
+
 class MCPClient:
     # Initialize session and client objects
     def __init__(self):
         self.session: Optional[ClientSession] = None
         self.exit_stack = AsyncExitStack()
-        self.deepseek_api_key = os.getenv("DEEPSEEK_API_KEY")
+        self._available_tools = ()
+        self._validators = {}
+        self._prefix_hash = None
+        self._connected = False
+        self.deepseek_api_key = _DEEPSEEK_API_KEY
         if not self.deepseek_api_key:
             raise ValueError("DEEPSEEK_API_KEY not found in .env file")
-        self.base_url = "https://api.deepseek.com/v1"  
-        
-        self.model = os.getenv("MODEL")
-        self.client = OpenAI(api_key=self.deepseek_api_key, base_url = self.base_url)
+        self.base_url = "https://api.deepseek.com/v1"
+
+        self.model = _MODEL
+        # One keep-alive connection pool for the whole session: no TLS
+        # handshake per completion call, HTTP/2 multiplexing when the
+        # endpoint supports it
+        self._http = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={
+                "Authorization": f"Bearer {self.deepseek_api_key}",
+                "Content-Type": "application/json"
+            },
+            http2=True,
+            timeout=httpx.Timeout(600.0, connect=10.0),
+            limits=httpx.Limits(max_keepalive_connections=8)
+        )
 
     # Connect to an MCP server:
     async def connect_to_server(self, server_script_path: str):
@@ -35,15 +114,18 @@ class MCPClient:
         Args:
             server_script_path: Path to the server script (.py or .js)
         """
+        if self._connected:
+            # The stdio subprocess and session are reused for the whole chat
+            # session; reconnecting would spawn a second subprocess and redo
+            # the handshake for nothing.
+            return
+
         if not os.path.exists(server_script_path):
             raise FileNotFoundError(f"Server file {server_script_path} does not exist")
 
         # 确定执行命令和参数
-        if server_script_path.endswith('.py'):
-            command = "python"
-            args = [server_script_path]
-        elif server_script_path.endswith('.js'):
-            command = "node"
+        command = _EXT_TO_CMD.get(os.path.splitext(server_script_path)[1])
+        if command is not None:
             args = [server_script_path]
         else:
             # 二进制文件情况
@@ -54,7 +136,7 @@ class MCPClient:
 
         server_params = StdioServerParameters(
             command=command,
-            args=[server_script_path],
+            args=args,
             env=None
         )
 
@@ -64,13 +146,87 @@ class MCPClient:
 
         await self.session.initialize()
 
-        # List available tools
+        self._connected = True
+
+        # List available tools once; the server's tool set is static within a session
+        await self.refresh_tools()
+        print("\nConnected to server with tools:", [t["function"]["name"] for t in self._available_tools])
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    async def refresh_tools(self):
+        """Re-fetch the tool list from the server and rebuild the cached schema."""
         response = await self.session.list_tools()
-        tools = response.tools
-        print("\nConnected to server with tools:", [tool.name for tool in tools])
+        # Frozen as a tuple: the same payload object is passed to every
+        # completion call and must never be rebuilt or mutated per turn
+        self._available_tools = tuple({
+            "type": "function",
+            "function": {
+                "name": tool.name,
+                "description": tool.description,
+                "parameters": tool.inputSchema
+            }
+        } for tool in response.tools)
+        # Compiled validators let us reject malformed tool args locally
+        # instead of paying an MCP round-trip for the server to bounce them
+        self._validators = {
+            tool.name: fastjsonschema.compile(tool.inputSchema)
+            for tool in response.tools
+        }
+
+    async def _stream_chat(self, messages):
+        """POST /chat/completions with stream=True and yield decoded SSE chunks.
+
+        The body is serialized with orjson and the SSE stream parsed by
+        hand (every payload line starts with "data: "), bypassing the
+        OpenAI SDK's per-call request construction and pydantic parsing.
+
+        DeepSeek context-caches stable request prefixes server-side, so
+        the system prompt and tools schema always come first and are
+        never rewritten; a hash guards against the prefix drifting and
+        silently turning every call into a full cache miss.
+        """
+        prefix_hash = hash((orjson.dumps(messages[0]), orjson.dumps(self._available_tools)))
+        if self._prefix_hash is None:
+            self._prefix_hash = prefix_hash
+        elif prefix_hash != self._prefix_hash:
+            logger.debug("stable prefix changed; server-side context cache will miss")
+            self._prefix_hash = prefix_hash
+
+        body = orjson.dumps({
+            "model": self.model,
+            "messages": messages,
+            "tools": self._available_tools,
+            "tool_choice": "auto",
+            "stream": True,
+            # Usage arrives in the final chunk and carries the
+            # prompt_cache_hit/miss token counts
+            "stream_options": {"include_usage": True}
+        })
+        async with self._http.stream("POST", "/chat/completions", content=body) as response:
+            if response.status_code != 200:
+                detail = (await response.aread()).decode(errors="replace")
+                raise RuntimeError(f"DeepSeek API returned {response.status_code}: {detail}")
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    break
+                yield orjson.loads(data)
+
+    async def process_query(self, query: str, echo: bool = True) -> str:
+        """Process a query using LLM and available tools.
+
+        With echo=False nothing is streamed to the terminal and only the
+        final response string is returned — used when several queries run
+        concurrently and live token streams would interleave.
+        """
+        if not self._connected:
+            raise RuntimeError("Not connected to an MCP server; call connect_to_server() first")
 
-    async def process_query(self, query: str) -> str:
-        """Process a query using LLM and available tools"""
         messages = [
             {
                 "role": "system",
@@ -85,106 +241,326 @@ class MCPClient:
         ]
         max_iterations = 10  # Prevent infinite loops
         for _ in range(max_iterations):
-            tool_response = await self.session.list_tools()
-            # print(f"\n Debug: {tool_response.tools}")
-
-            available_tools = [{
-                "type": "function",
-                "function": {
-                    "name": tool.name,
-                    "description": tool.description,
-                    # "input_schema": tool.inputSchema
-                    "parameters": tool.inputSchema
-                }
-            } for tool in tool_response.tools]
-
-            # 调用 OpenAI(Deepseek) API
-            print(f"\nDebug[request message:]: {messages}")
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                tools=available_tools,
-                tool_choice="auto"
-            )
-
-            print(f"\n Debug(deepseek response object): {response}")
+            # 调用 Deepseek API
+            # Guarded so the repr of the growing message history is only
+            # built when debug logging is actually enabled
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("request messages: %r", messages)
 
-            choice = response.choices[0]
-            message = choice.message
+            # Accumulate the streamed deltas: content tokens are printed as
+            # they arrive, tool_call fragments are reassembled by index.
+            content_parts = []
+            tool_calls = {}
+            finish_reason = None
+            pending = []
+            last_flush = time.monotonic()
+            async for chunk in self._stream_chat(messages):
+                usage = chunk.get("usage")
+                if usage and logger.isEnabledFor(logging.DEBUG):
+                    hit = usage.get("prompt_cache_hit_tokens", 0)
+                    miss = usage.get("prompt_cache_miss_tokens", 0)
+                    total = hit + miss
+                    logger.debug("prompt cache: %d/%d tokens hit (%.0f%%)",
+                                 hit, total, 100 * hit / total if total else 0.0)
+                choices = chunk.get("choices")
+                if not choices:
+                    continue
+                choice = choices[0]
+                delta = choice.get("delta") or {}
+                if delta.get("content"):
+                    content_parts.append(delta["content"])
+                    if echo:
+                        pending.append(delta["content"])
+                        now = time.monotonic()
+                        if now - last_flush >= _STREAM_FLUSH_INTERVAL:
+                            print("".join(pending), end="", flush=True)
+                            pending.clear()
+                            last_flush = now
+                for fragment in delta.get("tool_calls") or []:
+                    entry = tool_calls.setdefault(fragment["index"], {
+                        "id": "",
+                        "type": "function",
+                        "function": {"name": "", "arguments": ""}
+                    })
+                    if fragment.get("id"):
+                        entry["id"] = fragment["id"]
+                    function = fragment.get("function") or {}
+                    if function.get("name"):
+                        entry["function"]["name"] += function["name"]
+                    if function.get("arguments"):
+                        entry["function"]["arguments"] += function["arguments"]
+                if choice.get("finish_reason"):
+                    finish_reason = choice["finish_reason"]
+            if pending:
+                print("".join(pending), end="", flush=True)
+            content = "".join(content_parts)
 
             # Handle tool calls
-            if choice.finish_reason == "tool_calls" and message.tool_calls:
-                for tool_call in message.tool_calls:
-                    tool_name = tool_call.function.name
+            if finish_reason == "tool_calls" and tool_calls:
+                calls = [tool_calls[i] for i in sorted(tool_calls)]
+                # Guard against a turn's calls collapsing into N copies of
+                # the first one (e.g. a reassembly bug in the delta loop)
+                assert len({tc["id"] for tc in calls}) == len(calls), \
+                    "duplicate tool_call ids in one turn"
+
+                # One assistant message carrying every tool_call, followed by
+                # one tool message per call, matching the API's expected shape
+                messages.append({
+                    "role": "assistant",
+                    "content": content,
+                    "tool_calls": calls
+                })
+
+                parsed_args = []
+                tool_contents = [None] * len(calls)
+                for i, tool_call in enumerate(calls):
+                    tool_name = tool_call["function"]["name"]
                     try:
-                        tool_args = json.loads(tool_call.function.arguments)
-                    except json.JSONDecodeError as e:
+                        parsed_args.append(orjson.loads(tool_call["function"]["arguments"]))
+                    except orjson.JSONDecodeError as e:
                         print(f"Error parsing tool arguments: {e}")
-                        tool_args = {}
-
-                    print(f"\n[Executing {tool_name} with args {tool_args}]")
-                    try: 
-                        result = await self.session.call_tool(tool_name, tool_args)
-                        
-                        # Add both the assistant message and tool response to history
-                        messages.append({
-                            "role": "assistant",
-                            "content": "",
-                            "tool_calls": [
-                                {
-                                    "id": tool_call.id,
-                                    "function": {
-                                        "name": tool_name,
-                                        "arguments": tool_call.function.arguments
-                                    },
-                                    "type": "function"
-                                }
-                            ]
-                        })
-                        messages.append({
-                            "role": "tool",
-                            "name": tool_name,
-                            "content": str(result),
-                            "tool_call_id": tool_call.id
-                        })                        
+                        parsed_args.append({})
+                    # Validate locally against the cached schema; a malformed
+                    # call becomes its own tool result without ever reaching
+                    # the MCP server
+                    validator = self._validators.get(tool_name)
+                    if validator is not None:
+                        try:
+                            validator(parsed_args[i])
+                        except fastjsonschema.JsonSchemaException as e:
+                            tool_contents[i] = f"invalid args for {tool_name}: {e}"
+                            print(f"\n[Rejected {tool_name}: {e}]")
+                            continue
+                    print(f"\n[Executing {tool_name} with args {parsed_args[i]}]")
+
+                async def _run_tool(idx, tool_call, args):
+                    try:
+                        return idx, await self.session.call_tool(tool_call["function"]["name"], args)
                     except Exception as e:
-                        return f"Error executing {tool_name}: {str(e)}"
+                        return idx, e
+
+                to_run = [i for i in range(len(calls)) if tool_contents[i] is None]
+                if not to_run:
+                    done = []
+                elif len(to_run) == 1:
+                    done = [await _run_tool(to_run[0], calls[to_run[0]], parsed_args[to_run[0]])]
+                else:
+                    # Independent calls issued in one turn run concurrently,
+                    # so wall time is max(latency) instead of the sum. Results
+                    # are consumed as they complete so the stringifying and
+                    # printing of fast tools overlaps the slow ones; the next
+                    # LLM request fires the moment the last call lands.
+                    done = asyncio.as_completed([
+                        asyncio.ensure_future(_run_tool(i, calls[i], parsed_args[i]))
+                        for i in to_run
+                    ])
+
+                for finished in done:
+                    idx, result = finished if isinstance(finished, tuple) else await finished
+                    tool_name = calls[idx]["function"]["name"]
+                    if isinstance(result, Exception):
+                        tool_contents[idx] = f"Error executing {tool_name}: {str(result)}"
+                        print("\n" + tool_contents[idx])
+                    else:
+                        tool_contents[idx] = _tool_text(result)
+
+                for tool_call, tool_content in zip(calls, tool_contents):
+                    messages.append({
+                        "role": "tool",
+                        "name": tool_call["function"]["name"],
+                        "content": tool_content,
+                        "tool_call_id": tool_call["id"]
+                    })
+
+                _trim_history(messages)
             # If final response
             else:
-                return message.content
+                return content
+        if echo:
+            print("\nMaximum iterations reached without completing the request")
         return "Maximum iterations reached without completing the request"
 
     async def chat_loop(self):
-        """Run an interactive chat loop"""
+        """Run an interactive chat loop.
+
+        Stdin is read on a background thread into a queue. When several
+        queries are already pending (piped or scripted input) up to
+        MAX_QUERY_BATCH of them are processed concurrently over the shared
+        connection pool; interactive use still sees one query at a time.
+        """
         print("\nMCP Client Started!")
         print("Type your queries or 'quit' to exit.")
 
-        while True:
-            try:
-                query = input("\nQuery: ").strip()
+        queue: asyncio.Queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
 
-                if query.lower() == 'quit':
-                    break
+        def _read_stdin():
+            while True:
+                try:
+                    line = input("\nQuery: ")
+                except EOFError:
+                    loop.call_soon_threadsafe(queue.put_nowait, None)
+                    return
+                loop.call_soon_threadsafe(queue.put_nowait, line)
+
+        threading.Thread(target=_read_stdin, daemon=True).start()
 
-                response = await self.process_query(query)
-                print("\n" + response)
+        stop = False
+        while not stop:
+            query = await queue.get()
+            if query is None or query.strip().lower() == 'quit':
+                break
 
-            except Exception as e:
-                print(f"\nError: {str(e)}")
+            # Drain whatever else is already queued into one batch
+            batch = [query.strip()]
+            while len(batch) < _MAX_QUERY_BATCH and not queue.empty():
+                pending = queue.get_nowait()
+                if pending is None or pending.strip().lower() == 'quit':
+                    stop = True
+                    break
+                batch.append(pending.strip())
+            batch = [q for q in batch if q]
+            if not batch:
+                continue
+
+            if len(batch) == 1:
+                try:
+                    # process_query streams tokens to the terminal as they
+                    # arrive, so only a trailing newline is needed here.
+                    await self.process_query(batch[0])
+                    print()
+                except Exception as e:
+                    print(f"\nError: {str(e)}")
+            else:
+                # Concurrent queries must not stream — the interleaved token
+                # streams would be unreadable. Collect quietly and print each
+                # answer labeled with its query, failures included.
+                results = await asyncio.gather(
+                    *(self.process_query(q, echo=False) for q in batch),
+                    return_exceptions=True
+                )
+                for batched_query, result in zip(batch, results):
+                    if isinstance(result, BaseException):
+                        print(f"\n[{batched_query}]\nError: {str(result)}")
+                    else:
+                        print(f"\n[{batched_query}]\n{result}")
 
     async def cleanup(self):
         """Clean up resources"""
+        await self._http.aclose()
         await self.exit_stack.aclose()
+        self.session = None
+        self._connected = False
+
+def _write_frame(writer, payload):
+    """Write one length-prefixed (4-byte big-endian) JSON frame."""
+    data = orjson.dumps(payload)
+    writer.write(len(data).to_bytes(4, "big") + data)
+
+
+async def _read_frame(reader):
+    """Read one length-prefixed JSON frame; raises IncompleteReadError on EOF."""
+    header = await reader.readexactly(4)
+    return orjson.loads(await reader.readexactly(int.from_bytes(header, "big")))
+
+
+async def run_daemon(client):
+    """Serve queries over a Unix socket with an already-connected client.
+
+    Interpreter startup, the MCP subprocess spawn and the tool-list RPC
+    are paid once here; every thin-client invocation afterwards only
+    pays the socket round-trip.
+    """
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await _read_frame(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                try:
+                    response = await client.process_query(request["query"])
+                except Exception as e:
+                    response = f"Error: {str(e)}"
+                _write_frame(writer, {"response": response})
+                await writer.drain()
+        finally:
+            writer.close()
+
+    if os.path.exists(_DAEMON_SOCKET):
+        os.unlink(_DAEMON_SOCKET)
+    server = await asyncio.start_unix_server(handle, path=_DAEMON_SOCKET)
+    print(f"\nDaemon listening on {_DAEMON_SOCKET}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        # Unix socket files outlive the process; a leftover one would send
+        # the next plain invocation chasing a dead daemon
+        try:
+            os.unlink(_DAEMON_SOCKET)
+        except OSError:
+            pass
+
+
+async def thin_client_loop() -> bool:
+    """Forward queries to a running daemon instead of starting a client.
+
+    Returns False without entering the loop when nothing is listening on
+    the socket (e.g. a stale file left behind by a dead daemon).
+    """
+    try:
+        reader, writer = await asyncio.open_unix_connection(_DAEMON_SOCKET)
+    except (ConnectionRefusedError, OSError):
+        return False
+    print(f"\nConnected to daemon at {_DAEMON_SOCKET}")
+    print("Type your queries or 'quit' to exit.")
+    try:
+        while True:
+            query = (await asyncio.to_thread(input, "\nQuery: ")).strip()
+            if query.lower() == 'quit':
+                break
+            if not query:
+                continue
+            _write_frame(writer, {"query": query})
+            await writer.drain()
+            reply = await _read_frame(reader)
+            print("\n" + reply["response"])
+    except (EOFError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+    return True
+
 
 async def main():
-    if len(sys.argv) < 2:
-        print("Usage: python mcp_chatbot_deepseek.py <path_to_mcp_server> [support .py/.js/binary form]")
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+
+    args = [a for a in sys.argv[1:] if a != "--daemon"]
+    daemon = "--daemon" in sys.argv[1:]
+
+    # A live daemon socket means cold start can be skipped entirely
+    if not daemon and os.path.exists(_DAEMON_SOCKET):
+        if await thin_client_loop():
+            return
+        # Stale socket left by a dead daemon: remove it and fall through
+        # to the in-process path
+        try:
+            os.unlink(_DAEMON_SOCKET)
+        except OSError:
+            pass
+
+    if len(args) < 1:
+        print("Usage: python mcp_chatbot_deepseek.py [--daemon] <path_to_mcp_server> [support .py/.js/binary form]")
         sys.exit(1)
 
     client = MCPClient()
     try:
-        await client.connect_to_server(sys.argv[1])
-        await client.chat_loop()
+        await client.connect_to_server(args[0])
+        if daemon:
+            await run_daemon(client)
+        else:
+            await client.chat_loop()
     finally:
         await client.cleanup()
 
@@ -1,10 +1,13 @@
 import asyncio
 from typing import Optional
 from contextlib import AsyncExitStack
+import logging
 import os
+import threading
 import sys
 import requests
 import json
+import fastjsonschema
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 import ollama
@@ -13,15 +16,71 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Resolved once at import instead of per-instantiation / per-connect
+_MODEL = os.getenv("MODEL", "gemma3:12b")
+_OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+
+# O(1) dispatch from server-script extension to interpreter
+_EXT_TO_CMD = {".py": "python", ".js": "node"}
+
+# Max queries processed concurrently when several are already queued
+# on stdin (piped/scripted input); interactive use still sees one at a time.
+_MAX_QUERY_BATCH = int(os.getenv("MAX_QUERY_BATCH", "4"))
+
+# Character budget for the message history; past it, stale tool results
+# are elided so long tool chains stop re-sending O(N^2) bytes per turn.
+_MAX_HISTORY_CHARS = int(os.getenv("MAX_HISTORY_CHARS", "32000"))
+_ELIDED_KEEP = 200  # chars kept at each end of an elided tool result
+
+
+def _tool_text(result) -> str:
+    """Extract the textual payload from a CallToolResult.
+
+    str(result) reprs the whole object — base64 blobs, metadata and all —
+    inflating the prompt tokens of every later turn. Pull out the text
+    parts and fall back to JSON for structured content.
+    """
+    parts = []
+    for item in result.content:
+        text = getattr(item, "text", None)
+        parts.append(text if text is not None else json.dumps(item.model_dump()))
+    return "\n".join(parts)
+
+
+def _trim_history(messages):
+    """Elide old tool results in place once the history exceeds the budget.
+
+    The system prompt, user query and the most recent turns stay intact;
+    tool payloads older than the last two turns are cut down to their
+    first/last _ELIDED_KEEP chars.
+    """
+    total = sum(len(m.get("content") or "") for m in messages)
+    if total <= _MAX_HISTORY_CHARS:
+        return
+    for message in messages[:-4]:
+        content = message.get("content") or ""
+        if message.get("role") == "tool" and len(content) > 2 * _ELIDED_KEEP:
+            message["content"] = (
+                content[:_ELIDED_KEEP]
+                + f"\n...[{len(content) - 2 * _ELIDED_KEEP} chars elided]...\n"
+                + content[-_ELIDED_KEEP:]
+            )
+
 class MCPClient:
     # Initialize session and client objects
     def __init__(self):
         self.session: Optional[ClientSession] = None
         self.exit_stack = AsyncExitStack()
-        self.ollama_host = os.getenv("OLLAMA_HOST", "http://localhost:11434")
-        self.model = os.getenv("MODEL", "gemma3:12b")
+        self._available_tools = ()
+        self._validators = {}
+        self._connected = False
+        self.ollama_host = _OLLAMA_HOST
+        self.model = _MODEL
         if not self.ollama_host:
             raise ValueError("OLLAMA_HOST not found in .env file or default not set")
+        self.client = ollama.AsyncClient(host=self.ollama_host)
 
     # Connect to an MCP server
     async def connect_to_server(self, server_script_path: str):
@@ -30,15 +89,18 @@ class MCPClient:
         Args:
             server_script_path: Path to the server script (.py or .js)
         """
+        if self._connected:
+            # The stdio subprocess and session are reused for the whole chat
+            # session; reconnecting would spawn a second subprocess and redo
+            # the handshake for nothing.
+            return
+
         if not os.path.exists(server_script_path):
             raise FileNotFoundError(f"Server file {server_script_path} does not exist")
 
         # Determine execution command and arguments
-        if server_script_path.endswith('.py'):
-            command = "python"
-            args = [server_script_path]
-        elif server_script_path.endswith('.js'):
-            command = "node"
+        command = _EXT_TO_CMD.get(os.path.splitext(server_script_path)[1])
+        if command is not None:
             args = [server_script_path]
         else:
             # Binary file case
@@ -49,23 +111,51 @@ class MCPClient:
 
         server_params = StdioServerParameters(
             command=command,
-            args=[server_script_path],
+            args=args,
             env=None
         )
 
         stdio_transport = await self.exit_stack.enter_async_context(stdio_client(server_params))
-        self.stdio, self.client = stdio_transport
-        self.session = await self.exit_stack.enter_async_context(ClientSession(self.stdio, self.client))
+        self.stdio, self.write = stdio_transport
+        self.session = await self.exit_stack.enter_async_context(ClientSession(self.stdio, self.write))
 
         await self.session.initialize()
 
-        # List available tools
+        self._connected = True
+
+        # List available tools once; the server's tool set is static within a session
+        await self.refresh_tools()
+        print("\nConnected to server with tools:", [t["function"]["name"] for t in self._available_tools])
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    async def refresh_tools(self):
+        """Re-fetch the tool list from the server and rebuild the cached schema."""
         response = await self.session.list_tools()
-        tools = response.tools
-        print("\nConnected to server with tools:", [tool.name for tool in tools])
+        # Frozen as a tuple: the same payload object is passed to every
+        # chat call and must never be rebuilt or mutated per turn
+        self._available_tools = tuple({
+            "type": "function",
+            "function": {
+                "name": tool.name,
+                "description": tool.description,
+                "parameters": tool.inputSchema
+            }
+        } for tool in response.tools)
+        # Compiled validators let us reject malformed tool args locally
+        # instead of paying an MCP round-trip for the server to bounce them
+        self._validators = {
+            tool.name: fastjsonschema.compile(tool.inputSchema)
+            for tool in response.tools
+        }
 
     async def process_query(self, query: str) -> str:
         """Process a query using LLM and available tools"""
+        if not self._connected:
+            raise RuntimeError("Not connected to an MCP server; call connect_to_server() first")
+
         messages = [
             {
                 "role": "system",
@@ -80,30 +170,26 @@ class MCPClient:
         ]
         max_iterations = 10  # Prevent infinite loops
         for _ in range(max_iterations):
-            tool_response = await self.session.list_tools()
-            available_tools = [{
-                "type": "function",
-                "function": {
-                    "name": tool.name,
-                    "description": tool.description,
-                    "parameters": tool.inputSchema
-                }
-            } for tool in tool_response.tools]
-
             # Call Ollama API
             try:
-                response = ollama.chat(
+                response = await self.client.chat(
                     model="llama3.1",
                     messages=messages,
-                    tools=available_tools
+                    tools=self._available_tools
                 )
-                print(f"\nDebug: Response: {response}")
+                # Guarded so the response repr is only built when debug
+                # logging is actually enabled
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("ollama response: %r", response)
 
                 message = response["message"]
-                # print(f"\nDebug[ollama response]: {response_data}")
 
                 # Handle tool calls
                 if "tool_calls" in message and message["tool_calls"]:
+                    # One assistant message carrying every tool_call, followed
+                    # by one tool message per call — the response message
+                    # already has the right shape, no need to rebuild it
+                    messages.append(message)
                     for tool_call in message["tool_calls"]:
                         tool_name = tool_call["function"]["name"]
                         try:
@@ -112,24 +198,36 @@ class MCPClient:
                             print(f"Error: Invalid tool call format for {tool_name}")
                             tool_args = {}
 
+                        # Validate locally against the cached schema; a
+                        # malformed call becomes its own tool result without
+                        # ever reaching the MCP server
+                        validator = self._validators.get(tool_name)
+                        if validator is not None:
+                            try:
+                                validator(tool_args)
+                            except fastjsonschema.JsonSchemaException as e:
+                                print(f"\n[Rejected {tool_name}: {e}]")
+                                messages.append({
+                                    "role": "tool",
+                                    "name": tool_name,
+                                    "content": f"invalid args for {tool_name}: {e}",
+                                    "tool_call_id": tool_call.get("id", "unknown")
+                                })
+                                continue
+
                         print(f"\n[Executing {tool_name} with args {tool_args}]")
                         try:
                             result = await self.session.call_tool(tool_name, tool_args)
 
-                            # Add both the assistant message and tool response to history
-                            messages.append({
-                                "role": "assistant",
-                                "content": "",
-                                "tool_calls": [tool_call]
-                            })
                             messages.append({
                                 "role": "tool",
                                 "name": tool_name,
-                                "content": str(result),
+                                "content": _tool_text(result),
                                 "tool_call_id": tool_call.get("id", "unknown")
                             })
                         except Exception as e:
                             return f"Error executing {tool_name}: {str(e)}"
+                    _trim_history(messages)
                 # If final response
                 else:
                     return message["content"]
@@ -138,28 +236,70 @@ class MCPClient:
         return "Maximum iterations reached without completing the request"
 
     async def chat_loop(self):
-        """Run an interactive chat loop"""
+        """Run an interactive chat loop.
+
+        Stdin is read on a background thread into a queue. When several
+        queries are already pending (piped or scripted input) up to
+        MAX_QUERY_BATCH of them are processed concurrently; interactive
+        use still sees one query at a time.
+        """
         print("\nMCP Client Started!")
         print("Type your queries or 'quit' to exit.")
 
-        while True:
-            try:
-                query = input("\nQuery: ").strip()
+        queue: asyncio.Queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
 
-                if query.lower() == 'quit':
-                    break
+        def _read_stdin():
+            while True:
+                try:
+                    line = input("\nQuery: ")
+                except EOFError:
+                    loop.call_soon_threadsafe(queue.put_nowait, None)
+                    return
+                loop.call_soon_threadsafe(queue.put_nowait, line)
 
-                response = await self.process_query(query)
-                print("\n" + response)
+        threading.Thread(target=_read_stdin, daemon=True).start()
 
-            except Exception as e:
-                print(f"\nError: {str(e)}")
+        stop = False
+        while not stop:
+            query = await queue.get()
+            if query is None or query.strip().lower() == 'quit':
+                break
+
+            # Drain whatever else is already queued into one batch
+            batch = [query.strip()]
+            while len(batch) < _MAX_QUERY_BATCH and not queue.empty():
+                pending = queue.get_nowait()
+                if pending is None or pending.strip().lower() == 'quit':
+                    stop = True
+                    break
+                batch.append(pending.strip())
+            batch = [q for q in batch if q]
+            if not batch:
+                continue
+
+            # return_exceptions keeps one failing query from propagating
+            # while its siblings are still running; each outcome is
+            # reported individually in query order.
+            responses = await asyncio.gather(
+                *(self.process_query(q) for q in batch),
+                return_exceptions=True
+            )
+            for response in responses:
+                if isinstance(response, BaseException):
+                    print(f"\nError: {str(response)}")
+                else:
+                    print("\n" + response)
 
     async def cleanup(self):
         """Clean up resources"""
         await self.exit_stack.aclose()
+        self.session = None
+        self._connected = False
 
 async def main():
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+
     if len(sys.argv) < 2:
         print("Usage: python mcp_chatbot_ollama.py <path_to_mcp_server> [support .py/.js/binary form]")
         sys.exit(1)